@@ -1,5 +1,57 @@
 # Enhanced Features for ReviewGarden
 
+import io
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import streamlit as st
+
+# Copy-on-write: derived frames share buffers until written, so helpers
+# can skip defensive df.copy() without aliasing surprises
+pd.set_option("mode.copy_on_write", True)
+
+# Phone numbers are normalized to E.164 (+ followed by 10-15 digits)
+E164_PHONE_RE = re.compile(r"^\+[1-9]\d{9,14}$")
+PHONE_STRIP_RE = re.compile(r"\D")
+
+# Valid Google review URL patterns, combined into one compiled regex
+VALID_REVIEW_PATTERNS = (
+    "google.com/maps/place",
+    "search.google.com/local/writereview",
+    "g.page/",
+    "maps.app.goo.gl",
+)
+REVIEW_LINK_RE = re.compile('|'.join(re.escape(p) for p in VALID_REVIEW_PATTERNS))
+
+# Keywords that unsubscribe a number when they arrive by SMS
+STOP_WORDS = frozenset({"stop", "unsubscribe"})
+
+# Loose email shape check; character classes keep it backtracking-free
+EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+# Base templates by tier, shared by the scalar and bulk generators
+MESSAGE_TEMPLATES = {
+    "vip": (
+        "Hi {name}! As one of our valued customers at {business}, we'd love to hear about your recent {service}. Your feedback helps us maintain the exceptional service you deserve.",
+        "{name}, thank you for choosing {business} for your {service}. We hope it exceeded your expectations! Would you share your experience?"
+    ),
+    "standard": (
+        "Hi {name}! We hope you loved your {service} at {business}. Mind sharing a quick review?",
+        "Hey {name}! Thanks for visiting {business}. How was your {service}? We'd appreciate your feedback!"
+    ),
+    "first_time": (
+        "Welcome to {business}, {name}! We hope your first {service} was great. We'd love to hear what you think!",
+        "Hi {name}! Thanks for trying {business}. Your first impression matters to us - would you leave a review?"
+    )
+}
+
 # ==================== 1. IMPROVED STATE MANAGEMENT ====================
 def init_session_state():
     """Initialize all session state variables in one place"""
@@ -12,11 +64,27 @@ def init_session_state():
         "campaign_results": None,
         "opt_out_list": set(),  # NEW: Track opt-outs
         "campaign_history": [],  # NEW: Store all campaigns
+        "celebrate": True,  # NEW: Balloons after a successful send
     }
     for key, default in defaults.items():
         if key not in st.session_state:
             st.session_state[key] = default
 
+    # Migration guard: opt-out lookups rely on O(1) set membership
+    if not isinstance(st.session_state.opt_out_list, set):
+        st.session_state.opt_out_list = set(st.session_state.opt_out_list)
+
+def clear_session_state(keep=()):
+    """Bulk-reset session state, optionally preserving some keys
+
+    One clear() beats deleting keys one by one (each del pays widget
+    bookkeeping); defaults are re-seeded afterwards.
+    """
+    saved = {k: st.session_state[k] for k in keep if k in st.session_state}
+    st.session_state.clear()
+    st.session_state.update(saved)
+    init_session_state()
+
 # ==================== 2. ENHANCED MESSAGE GENERATION ====================
 def generate_smart_message(business_name, customer_name, service_type="", 
                           service_date="", customer_tier="standard"):
@@ -26,25 +94,9 @@ def generate_smart_message(business_name, customer_name, service_type="",
     - Better personalization
     - More natural language
     """
-    
-    # Base templates by tier
-    templates = {
-        "vip": [
-            "Hi {name}! As one of our valued customers at {business}, we'd love to hear about your recent {service}. Your feedback helps us maintain the exceptional service you deserve.",
-            "{name}, thank you for choosing {business} for your {service}. We hope it exceeded your expectations! Would you share your experience?"
-        ],
-        "standard": [
-            "Hi {name}! We hope you loved your {service} at {business}. Mind sharing a quick review?",
-            "Hey {name}! Thanks for visiting {business}. How was your {service}? We'd appreciate your feedback!"
-        ],
-        "first_time": [
-            "Welcome to {business}, {name}! We hope your first {service} was great. We'd love to hear what you think!",
-            "Hi {name}! Thanks for trying {business}. Your first impression matters to us - would you leave a review?"
-        ]
-    }
-    
-    tier = customer_tier if customer_tier in templates else "standard"
-    template = random.choice(templates[tier])
+
+    tier = customer_tier if customer_tier in MESSAGE_TEMPLATES else "standard"
+    template = random.choice(MESSAGE_TEMPLATES[tier])
     
     # Smart substitution
     params = {
@@ -67,6 +119,68 @@ def generate_smart_message(business_name, customer_name, service_type="",
     
     return message
 
+def generate_smart_messages(df):
+    """
+    Vectorized version of generate_smart_message for a whole DataFrame.
+
+    Expects 'Business Name' and 'Customer Name' columns; uses
+    'Service Type', 'Service Date' and 'Customer Tier' when present.
+    Returns a Series of messages aligned to df's index.
+    """
+    first_names = df['Customer Name'].astype(str).str.split(n=1).str[0]
+    businesses = df['Business Name'].astype(str)
+
+    if 'Service Type' in df.columns:
+        # Cast off the loader's category dtype first: fillna('') raises on
+        # a categorical that doesn't already have '' as a category
+        services = df['Service Type'].astype('string').fillna('').astype(str)
+        services = services.where(services != '', 'visit')
+    else:
+        services = pd.Series('visit', index=df.index)
+
+    if 'Customer Tier' in df.columns:
+        # astype(object) so where() can introduce 'standard' even when it
+        # isn't one of the column's categories
+        tiers = df['Customer Tier'].astype(object).where(
+            df['Customer Tier'].isin(MESSAGE_TEMPLATES), 'standard'
+        )
+    else:
+        tiers = pd.Series('standard', index=df.index)
+
+    # Date suffix from one vectorized to_datetime pass (the scalar version
+    # re-parses the date string on every call)
+    if 'Service Date' in df.columns:
+        days_ago = (datetime.now() - parse_service_dates(df['Service Date'])).dt.days
+        day_strs = days_ago.fillna(-1).astype(int).astype(str)
+        suffix = np.where(days_ago.le(7), ' (from ' + day_strs + ' days ago)', '')
+    else:
+        suffix = np.full(len(df), '', dtype=object)
+
+    messages = pd.Series('', index=df.index, dtype=object)
+    for tier, templates in MESSAGE_TEMPLATES.items():
+        mask = (tiers == tier).to_numpy()
+        count = int(mask.sum())
+        if not count:
+            continue
+        picks = np.random.randint(len(templates), size=count)
+        messages.iloc[mask] = [
+            templates[pick].format(name=name, business=business, service=service)
+            for pick, name, business, service in zip(
+                picks, first_names.iloc[mask], businesses.iloc[mask], services.iloc[mask]
+            )
+        ]
+
+    return messages + suffix
+
+def build_sms_bodies(df):
+    """
+    Materialize the final SMS body for every row in one C-level concat,
+    so a dispatch loop only has to hand strings to the API.
+    """
+    return (df['Generated_Message'].astype(str) + ' '
+            + df['Review Link'].astype(str)
+            + ' Reply STOP to opt out.')
+
 # ==================== 3. OPT-OUT MANAGEMENT ====================
 def check_opt_out(phone):
     """Check if phone number has opted out"""
@@ -76,15 +190,37 @@ def add_opt_out(phone):
     """Add phone to opt-out list"""
     st.session_state.opt_out_list.add(phone)
     # In production: Save to database
-    
+
+def filter_opt_outs(df):
+    """Drop opted-out recipients in bulk before sending (hashed isin, O(n+m))
+
+    Assumes Phone is already E.164-normalized by validate_phone_series,
+    so no per-row str()/strip() is needed here or in the send loop.
+    """
+    return df[~df['Phone'].isin(st.session_state.opt_out_list)].reset_index(drop=True)
+
+def filter_sendable(df):
+    """Shrink a campaign frame to rows that can actually be sent
+
+    Dropping rows with a missing phone or message up front means the
+    dispatch loop never pays per-row skip checks.
+    """
+    mask = df['Phone'].notna()
+    if 'Generated_Message' in df.columns:
+        mask &= df['Generated_Message'].notna()
+    return df[mask].reset_index(drop=True)
+
+
 def handle_incoming_sms(from_number, body):
     """
     Handle incoming SMS responses
     In production: Set up Twilio webhook
     """
     body_lower = body.lower().strip()
-    
-    if any(word in body_lower for word in ["stop", "unsubscribe", "opt out"]):
+
+    # Tokenize with punctuation stripped so "STOP." / "unsubscribe!" still
+    # opt out — this is the compliance path, err on the side of matching
+    if not STOP_WORDS.isdisjoint(re.findall(r'[a-z]+', body_lower)) or "opt out" in body_lower:
         add_opt_out(from_number)
         return "You've been unsubscribed. Reply START to resubscribe."
     
@@ -95,63 +231,222 @@ def handle_incoming_sms(from_number, body):
     return None  # Not a command
 
 # ==================== 4. ENHANCED VALIDATION ====================
+
+# Explicit dtypes keep uploads compact (category/string instead of object)
+# and let the date column parse during the read instead of a second pass
+CSV_DTYPES = {
+    'Business Name': 'category',
+    'Customer Name': 'string',
+    'Email': 'string',
+    'Phone': 'string',
+    'Review Link': 'string',
+    'Service Type': 'category',
+    'Customer Tier': 'category',
+}
+CSV_PARSE_DATES = ['Service Date']
+CSV_COLUMNS = frozenset(CSV_DTYPES) | frozenset(CSV_PARSE_DATES)
+
+# Immutable sample CSV for the download-template button; building this
+# from a DataFrame on every rerun is pure waste
+TEMPLATE_CSV = (
+    b"Business Name,Customer Name,Email,Phone,Service Date,Service Type,Review Link\n"
+    b"Garden Cafe,John Smith,john@example.com,+15555550100,2024-01-15,Lunch Service,"
+    b"https://search.google.com/local/writereview?placeid=EXAMPLE\n"
+)
+
+@st.cache_data(show_spinner=False)
+def _read_customer_csv(file_bytes):
+    """Cached parse keyed on the raw upload bytes"""
+    kwargs = dict(
+        dtype=CSV_DTYPES,
+        parse_dates=CSV_PARSE_DATES,
+        usecols=lambda c: c.strip() in CSV_COLUMNS
+    )
+    # Large uploads parse in bounded chunks instead of one giant pass
+    if len(file_bytes) > 5_000_000:
+        with pd.read_csv(io.BytesIO(file_bytes), chunksize=10_000, **kwargs) as reader:
+            return pd.concat(reader, ignore_index=True)
+    return pd.read_csv(io.BytesIO(file_bytes), **kwargs)
+
+def load_customer_csv(uploaded_file):
+    """Read an uploaded customer CSV with declared dtypes and columns
+
+    Reruns with the same upload hit the st.cache_data entry instead of
+    re-parsing the file on every widget interaction.
+    """
+    return _read_customer_csv(uploaded_file.getvalue())
+
+def parse_service_dates(s):
+    """
+    Vectorized Service Date parsing for a whole column.
+
+    Handles normal date strings plus Excel serial numbers (the raw
+    numeric values some spreadsheet exports produce) in two C-level
+    passes; unparseable values coerce to NaT.
+    """
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s
+
+    parsed = pd.to_datetime(s, errors='coerce')
+    numeric = pd.to_numeric(s, errors='coerce')
+    serial = numeric.notna() & parsed.isna()
+    if serial.any():
+        parsed[serial] = pd.to_datetime(
+            numeric[serial], unit='D', origin='1899-12-30', errors='coerce'
+        )
+    return parsed
+
 def validate_review_link(link):
     """Validate Google review link format"""
     if pd.isna(link) or not link:
         return False, "Missing review link"
     
     link_str = str(link).strip()
-    
-    # Check for valid Google review URL patterns
-    valid_patterns = [
-        "google.com/maps/place",
-        "search.google.com/local/writereview",
-        "g.page/",
-        "maps.app.goo.gl"
-    ]
-    
-    if not any(pattern in link_str for pattern in valid_patterns):
+
+    if not REVIEW_LINK_RE.search(link_str):
         return False, "Invalid Google review link"
     
     return True, link_str
 
+def validate_phone_number(phone):
+    """
+    Scalar phone validation for single-value callers (webhooks, forms).
+
+    Returns (True, cleaned) or (False, original). Column-wide callers
+    should use validate_phone_series instead.
+    """
+    if pd.isna(phone):
+        return False, "Missing phone number"
+
+    phone_str = str(phone).strip()
+
+    # Fast path: already canonical E.164, nothing to strip or prefix
+    if phone_str.startswith('+') and E164_PHONE_RE.match(phone_str):
+        return True, phone_str
+
+    # Recover float-mangled input ("5551234567.0", "5.55e+09") the same
+    # way validate_phone_series does; stripping non-digits directly would
+    # keep the mantissa digits and approve a corrupted number. Input that
+    # isn't actually a float ("555.123.4567") falls through to the normal
+    # digit strip, mirroring the series' coerce-then-keep-original path.
+    digits_src = phone_str
+    if not phone_str.startswith('+') and ('.' in phone_str or 'e' in phone_str.lower()):
+        try:
+            digits_src = '{:.0f}'.format(float(phone_str))
+        except (ValueError, OverflowError):
+            pass
+
+    digits = PHONE_STRIP_RE.sub('', digits_src)
+    if phone_str.startswith('+'):
+        cleaned = '+' + digits
+    elif len(digits) == 10:
+        cleaned = '+1' + digits
+    else:
+        cleaned = '+' + digits
+
+    if E164_PHONE_RE.match(cleaned):
+        return True, cleaned
+    return False, phone_str
+
+def validate_phone_series(s):
+    """
+    Vectorized phone validation over a whole column.
+
+    Returns (cleaned, ok): normalized E.164 strings plus a boolean mask
+    of which rows match. One C-level pass, no per-scalar regex calls.
+    """
+    phones = s.astype(str).str.strip()
+
+    # Recover numbers that arrived as floats ("5551234567.0", "5.55e+09"
+    # from Excel exports) before stripping non-digits, which would
+    # otherwise keep the mantissa digits and corrupt the number
+    floaty = phones.str.contains(r'[.eE]', na=False) & ~phones.str.startswith('+')
+    if floaty.any():
+        recovered = pd.to_numeric(phones[floaty], errors='coerce')
+        phones.update(recovered.dropna().map('{:.0f}'.format))
+
+    digits = phones.str.replace(r'\D', '', regex=True)
+    cleaned = pd.Series(
+        np.select(
+            [phones.str.startswith('+'),
+             digits.str.len() == 10],
+            ['+' + digits, '+1' + digits],
+            default='+' + digits
+        ),
+        index=s.index
+    )
+    return cleaned, cleaned.str.match(E164_PHONE_RE)
+
 def enhanced_csv_validation(df):
-    """More comprehensive CSV validation"""
+    """More comprehensive CSV validation (fully vectorized - no per-row loops)"""
     issues = []
     warnings = []
-    
-    for idx, row in df.iterrows():
-        row_num = idx + 2  # Excel row number
-        
-        # Phone validation
-        is_valid, result = validate_phone_number(row['Phone'])
-        if not is_valid:
-            issues.append(f"Row {row_num}: Invalid phone - {result}")
-        else:
-            df.at[idx, 'Phone'] = result
-            
-            # Check opt-out list
-            if check_opt_out(result):
-                warnings.append(f"Row {row_num}: {row['Customer Name']} has opted out")
-        
-        # Review link validation
-        is_valid, result = validate_review_link(row['Review Link'])
-        if not is_valid:
-            issues.append(f"Row {row_num}: {result}")
-        
-        # Email format check (warning only)
-        email = str(row.get('Email', '')).strip()
-        if email and '@' not in email:
-            warnings.append(f"Row {row_num}: Suspicious email format")
-        
-        # Check for duplicate phones
-        duplicates = df[df['Phone'] == row['Phone']]
-        if len(duplicates) > 1:
-            warnings.append(f"Row {row_num}: Duplicate phone number")
-    
+
+    row_nums = df.index.to_numpy() + 2  # Excel row numbers
+
+    # Phone validation: normalize to E.164 and match in one pass
+    cleaned, phone_valid = validate_phone_series(df['Phone'])
+    issues.extend(
+        f"Row {n}: Invalid phone - {p}"
+        for n, p in zip(row_nums[~phone_valid], df['Phone'].astype(str)[~phone_valid])
+    )
+
+    # Opt-out check on the normalized numbers (hashed set lookup, O(n))
+    opted_out = phone_valid & cleaned.isin(st.session_state.opt_out_list)
+    names = df['Customer Name'].astype(str)
+    warnings.extend(
+        f"Row {n}: {name} has opted out"
+        for n, name in zip(row_nums[opted_out], names[opted_out])
+    )
+
+    # Review link validation via a single combined regex scan
+    links = df['Review Link'].astype(str).str.strip()
+    link_missing = df['Review Link'].isna() | links.eq('')
+    link_invalid = ~link_missing & ~links.str.contains(REVIEW_LINK_RE, na=False)
+    issues.extend(f"Row {n}: Missing review link" for n in row_nums[link_missing])
+    issues.extend(f"Row {n}: Invalid Google review link" for n in row_nums[link_invalid])
+
+    # Email format check (warning only)
+    if 'Email' in df.columns:
+        emails = df['Email'].fillna('').astype(str).str.strip()
+        suspicious = emails.ne('') & ~emails.str.match(EMAIL_RE)
+        warnings.extend(f"Row {n}: Suspicious email format" for n in row_nums[suspicious])
+
+    # Duplicate phones: linear duplicated() pass instead of an O(n^2) scan,
+    # restricted to valid rows (invalid phones all normalize to similar
+    # junk and would pair up as false duplicates)
+    dup_mask = phone_valid & cleaned.where(phone_valid).duplicated(keep=False)
+    warnings.extend(f"Row {n}: Duplicate phone number" for n in row_nums[dup_mask])
+
+    # Write cleaned phones back in a single masked assignment
+    df['Phone'] = cleaned.where(phone_valid, df['Phone'])
+
     return df, issues, warnings
 
 # ==================== 5. ANALYTICS DASHBOARD ====================
+def campaign_counts(df):
+    """
+    Readiness counts for the campaign summary, recomputed only when the
+    frame actually changes: one hash pass detects change, unchanged
+    frames reuse the cached scalars instead of rescanning columns on
+    every rerun.
+    """
+    frame_hash = int(pd.util.hash_pandas_object(df, index=False).sum())
+    cached = st.session_state.get('_count_cache')
+    if cached and cached[0] == frame_hash:
+        return cached[1]
+
+    # One fused notna pass over both columns instead of a scan per metric
+    cols = [c for c in ('Phone', 'Generated_Message') if c in df.columns]
+    present = df[cols].notna().sum()
+    counts = {
+        'total': len(df),
+        'valid_phones': int(present.get('Phone', 0)),
+        'messages_ready': int(present.get('Generated_Message', 0)),
+    }
+    st.session_state['_count_cache'] = (frame_hash, counts)
+    return counts
+
 def render_analytics():
     """Enhanced analytics dashboard"""
     st.header("📊 Campaign Analytics")
@@ -172,8 +467,10 @@ def render_analytics():
     col3.metric("Avg Success Rate", f"{avg_success:.1f}%")
     col4.metric("Opt-outs", len(st.session_state.opt_out_list))
     
-    # Campaign timeline
+    # Campaign timeline - cap what goes over the wire; Streamlit ships
+    # the whole frame as Arrow IPC, linear in cells
     st.subheader("Campaign History")
+    recent = st.session_state.campaign_history[-100:]
     history_df = pd.DataFrame([
         {
             "Date": c['timestamp'].strftime("%Y-%m-%d %H:%M"),
@@ -182,9 +479,11 @@ def render_analytics():
             "Success Rate": f"{(c['sent']/(c['sent']+c['failed'])*100):.1f}%" if c['sent']+c['failed'] > 0 else "0%",
             "Mode": "Test" if c.get('test_mode') else "Live"
         }
-        for c in st.session_state.campaign_history
+        for c in recent
     ])
     st.dataframe(history_df, use_container_width=True)
+    if len(st.session_state.campaign_history) > len(recent):
+        st.caption(f"Showing last {len(recent)} of {len(st.session_state.campaign_history)} campaigns")
 
 # ==================== 6. CAMPAIGN SCHEDULER ====================
 def schedule_campaign(df, send_time):
@@ -210,78 +509,208 @@ def schedule_campaign(df, send_time):
 def segment_customers(df):
     """Segment customers for targeted campaigns"""
     segments = {}
-    
-    # By service type
+
+    # By service type - one groupby pass instead of a scan per unique value
     if 'Service Type' in df.columns:
-        for service_type in df['Service Type'].unique():
-            if pd.notna(service_type):
-                segments[f"Service: {service_type}"] = df[df['Service Type'] == service_type]
-    
-    # By recency (if service date available)
+        for service_type, group in df.groupby('Service Type', dropna=True):
+            segments[f"Service: {service_type}"] = group
+
+    # By recency (if service date available) - bucket with a single pd.cut,
+    # without mutating df with helper columns
     if 'Service Date' in df.columns:
-        try:
-            df['Date_Parsed'] = pd.to_datetime(df['Service Date'], errors='coerce')
-            df['Days_Ago'] = (datetime.now() - df['Date_Parsed']).dt.days
-            
-            segments["Recent (0-7 days)"] = df[df['Days_Ago'] <= 7]
-            segments["This month (8-30 days)"] = df[(df['Days_Ago'] > 7) & (df['Days_Ago'] <= 30)]
-            segments["Older (30+ days)"] = df[df['Days_Ago'] > 30]
-        except:
-            pass
-    
+        days_ago = (datetime.now() - parse_service_dates(df['Service Date'])).dt.days
+        buckets = pd.cut(
+            days_ago,
+            bins=[-np.inf, 7, 30, np.inf],
+            labels=["Recent (0-7 days)", "This month (8-30 days)", "Older (30+ days)"]
+        )
+        for label, group in df.groupby(buckets, observed=False):
+            segments[str(label)] = group
+
     return segments
 
 # ==================== 8. RATE LIMITING IMPROVEMENTS ====================
+
+# One alternation scan classifies provider errors instead of a chain of
+# sequential substring searches; lastgroup picks the friendly message
+SEND_ERROR_RE = re.compile(
+    r'(?P<perm>permission denied)'
+    r'|(?P<invalid>is not a valid phone number)'
+    r'|(?P<rate>rate limit)'
+    r'|(?P<overflow>overflow)'
+    r'|(?P<auth>authenticate)',
+    re.IGNORECASE
+)
+SEND_ERROR_MESSAGES = {
+    'perm': "Not authorized to send to this number",
+    'invalid': "Invalid phone number format",
+    'rate': "Rate limit exceeded - please slow down",
+    'overflow': "Message queue overflow - try again later",
+    'auth': "Twilio authentication failed",
+}
+
+def classify_send_error(error_msg):
+    """Map a raw provider error to a user-friendly message"""
+    match = SEND_ERROR_RE.search(str(error_msg))
+    return SEND_ERROR_MESSAGES[match.lastgroup] if match else str(error_msg)
+
+def retry_with_backoff(func, attempts=3, base_delay=0.5, max_delay=10):
+    """
+    Call func(), retrying throttle errors with exponential backoff.
+
+    Retries when the error looks like a rate limit (HTTP 429 or
+    throttle wording); anything else propagates immediately so real
+    failures aren't masked. Returns func()'s result.
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            retriable = getattr(e, 'status', None) == 429 or any(
+                word in str(e).lower()
+                for word in ("rate limit", "throttle", "too many requests")
+            )
+            if not retriable or attempt == attempts - 1:
+                raise
+            time.sleep(min(base_delay * 2 ** attempt, max_delay))
+
+class TokenBucket:
+    """
+    Monotonic-clock token bucket for pacing concurrent senders.
+
+    Unlike RateLimiter (which answers "may I send now?" for a serial
+    loop), this blocks worker threads until a token is available, so a
+    ThreadPoolExecutor full of in-flight requests still respects the
+    provider's messages-per-second quota.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1, rate))
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` are available, then consume them"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.last_refill) * self.rate
+                )
+                self.last_refill = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
 class RateLimiter:
     """Smart rate limiter with burst handling"""
     
     def __init__(self, max_per_hour=100, max_burst=10):
         self.max_per_hour = max_per_hour
         self.max_burst = max_burst
-        self.sent_times = []
-    
+        self.sent_times = deque()  # append-only, so always sorted
+        self._hour = timedelta(hours=1)
+        self._burst_window = timedelta(seconds=10)
+
+    def _expire(self, now):
+        """Drop entries older than an hour from the left in O(expired)"""
+        hour_ago = now - self._hour
+        while self.sent_times and self.sent_times[0] <= hour_ago:
+            self.sent_times.popleft()
+
     def can_send(self):
         """Check if we can send based on rate limits"""
         now = datetime.now()
-        hour_ago = now - pd.Timedelta(hours=1)
-        
-        # Clean old entries
-        self.sent_times = [t for t in self.sent_times if t > hour_ago]
-        
+        self._expire(now)
+
         # Check limits
         if len(self.sent_times) >= self.max_per_hour:
             return False, "Hourly limit reached"
-        
-        # Check burst (last 10 seconds)
-        recent = [t for t in self.sent_times if t > now - pd.Timedelta(seconds=10)]
-        if len(recent) >= self.max_burst:
-            return False, "Burst limit reached"
-        
+
+        # Check burst (last 10 seconds) - walk the tail, stop at the window edge
+        burst_cutoff = now - self._burst_window
+        recent = 0
+        for t in reversed(self.sent_times):
+            if t <= burst_cutoff:
+                break
+            recent += 1
+            if recent >= self.max_burst:
+                return False, "Burst limit reached"
+
         return True, None
-    
+
     def record_sent(self):
         """Record a sent message"""
         self.sent_times.append(datetime.now())
-    
+
     def get_wait_time(self):
         """Calculate how long to wait before next send"""
         if not self.sent_times:
             return 0
-        
+
         now = datetime.now()
-        hour_ago = now - pd.Timedelta(hours=1)
-        recent_sends = [t for t in self.sent_times if t > hour_ago]
-        
-        if len(recent_sends) >= self.max_per_hour:
-            oldest = min(recent_sends)
-            wait = (oldest + pd.Timedelta(hours=1) - now).total_seconds()
+        self._expire(now)
+
+        if len(self.sent_times) >= self.max_per_hour:
+            # Oldest entry is at the head; no filter or min() needed
+            wait = (self.sent_times[0] + self._hour - now).total_seconds()
             return max(0, wait)
-        
+
         return 1  # Default delay
 
 # ==================== 9. EXPORT ENHANCEMENTS ====================
+
+# Status labels are tiny-cardinality; categorical storage keeps one str
+# per category instead of one per cell and compares by integer code
+STATUS_DTYPE = pd.CategoricalDtype(categories=['', '✅ Sent', '❌ Failed'])
+
+def init_tracking_columns(df):
+    """Initialize per-recipient campaign tracking columns in one assign"""
+    empty_status = pd.Series('', index=df.index, dtype=STATUS_DTYPE)
+    return df.assign(
+        SMS_Status=empty_status,
+        Email_Status=empty_status,
+        Error='',
+        Sent_Time=''
+    )
+
+def df_to_csv_bytes(df):
+    """Serialize a DataFrame straight into bytes for st.download_button
+
+    Writing into BytesIO avoids building a giant Python str and the
+    extra encode pass Streamlit would otherwise do.
+    """
+    buf = io.BytesIO()
+    df.to_csv(buf, index=False)
+    return buf.getvalue()
+
+@st.cache_data(show_spinner=False)
+def _gzip_csv(_df, df_hash):
+    """Cached gzip serialization; _df skips Streamlit's hash pass"""
+    buf = io.BytesIO()
+    _df.to_csv(buf, index=False, compression='gzip')
+    return buf.getvalue()
+
+def df_to_csv_gzip(df):
+    """Gzipped CSV bytes for large result downloads
+
+    Cached on a cheap pandas row hash so hovering the download button
+    across reruns doesn't re-serialize tens of MB each time.
+    """
+    return _gzip_csv(df, int(pd.util.hash_pandas_object(df).sum()))
+
 def export_campaign_report(df, campaign_results):
     """Generate comprehensive campaign report"""
+    # Plain-substring scan, no regex engine; fold in email failures if tracked
+    failed_mask = df['SMS_Status'].str.contains('Failed', regex=False, na=False)
+    if 'Email_Status' in df.columns:
+        failed_mask |= df['Email_Status'].str.contains('Failed', regex=False, na=False)
+
     report = {
         "summary": {
             "timestamp": campaign_results['timestamp'].isoformat(),
@@ -291,27 +720,202 @@ def export_campaign_report(df, campaign_results):
             "skipped": campaign_results['skipped'],
             "success_rate": f"{(campaign_results['sent']/(campaign_results['sent']+campaign_results['failed'])*100):.2f}%"
         },
-        "failures": df[df['SMS_Status'].str.contains('Failed', na=False)][
-            ['Customer Name', 'Phone', 'Error']
-        ].to_dict('records'),
-        "opt_outs": list(st.session_state.opt_out_list)
+        "failures": df.loc[failed_mask, ['Customer Name', 'Phone', 'Error']].to_dict('records'),
+        "opt_outs": sorted(st.session_state.opt_out_list)
     }
     
     return report
 
 # ==================== 10. UI IMPROVEMENTS ====================
-def render_progress_with_eta(current, total, start_time):
-    """Show progress bar with ETA"""
+def inject_css(css):
+    """Emit the app's <style> block for this script run
+
+    Streamlit removes elements that aren't re-emitted on a rerun, so the
+    CSS must be sent every run or the app un-styles itself after the
+    first widget interaction; the repeated ~KB payload is the price of
+    staying styled.
+    """
+    st.markdown(f"<style>{css}</style>", unsafe_allow_html=True)
+
+def render_progress_with_eta(current, total, start_time, update_every=10):
+    """
+    Show progress bar with ETA.
+
+    Updates are throttled (every `update_every` rows or ~200ms) and the
+    widgets live in st.empty() placeholders that are re-filled in place,
+    so per-send calls don't push a frontend delta per iteration.
+    """
+    # Placeholders from a previous script run are stale DeltaGenerators
+    # that render nothing, so rebuild the dict whenever a new campaign
+    # (new start_time) comes through
+    state = st.session_state.get('_progress_widgets')
+    if state is None or state.get('start_time') != start_time:
+        state = {'start_time': start_time}
+        st.session_state['_progress_widgets'] = state
+
+    now = time.monotonic()
+    if current < total and current % update_every and now - state.get('last_update', 0.0) < 0.2:
+        return
+    state['last_update'] = now
+
+    if 'bar' not in state:
+        state['bar'] = st.empty()
+        state['metrics'] = st.empty()
+
     elapsed = (datetime.now() - start_time).total_seconds()
     rate = current / elapsed if elapsed > 0 else 0
     remaining = total - current
     eta_seconds = remaining / rate if rate > 0 else 0
-    
-    progress = current / total
     eta_str = f"{int(eta_seconds // 60)}m {int(eta_seconds % 60)}s"
-    
-    st.progress(progress)
-    col1, col2, col3 = st.columns(3)
-    col1.metric("Progress", f"{current}/{total}")
-    col2.metric("Rate", f"{rate:.1f}/sec")
-    col3.metric("ETA", eta_str)
+
+    state['bar'].progress(current / total)
+    with state['metrics'].container():
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Progress", f"{current}/{total}")
+        col2.metric("Rate", f"{rate:.1f}/sec")
+        col3.metric("ETA", eta_str)
+
+def maybe_celebrate(campaign_results):
+    """Fire st.balloons() only when it's cheap and wanted
+
+    The balloon animation is a full-canvas overlay the frontend has to
+    composite; skip it when the user turned it off, during test runs,
+    and for big campaigns where the rerun right after a long send loop
+    is already janky enough.
+    """
+    if not st.session_state.get('celebrate', True):
+        return
+    if campaign_results.get('test_mode'):
+        return
+    sent = campaign_results.get('sent', 0)
+    if 0 < sent < 100:
+        st.balloons()
+
+# ==================== 11. CAMPAIGN PERSISTENCE ====================
+CAMPAIGN_DB_PATH = "campaigns.db"
+
+def init_campaign_db():
+    """Open the campaign database, creating the schema on first use
+
+    WAL journaling turns the bursty end-of-campaign writes into
+    sequential log appends (and lets history reads proceed during a
+    save); the remaining pragmas trade a little durability for far
+    fewer fsyncs, which is the right call for reproducible campaign
+    logs.
+    """
+    conn = sqlite3.connect(CAMPAIGN_DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA busy_timeout=3000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS campaigns (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp TEXT NOT NULL,
+            sent INTEGER NOT NULL,
+            failed INTEGER NOT NULL,
+            skipped INTEGER NOT NULL,
+            test_mode INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS campaign_details (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            campaign_id INTEGER NOT NULL,
+            customer_name TEXT,
+            phone TEXT,
+            status TEXT,
+            error_message TEXT,
+            sent_time TEXT
+        )
+    """)
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_campaign_details_campaign_id"
+        " ON campaign_details(campaign_id)"
+    )
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_campaigns_timestamp"
+        " ON campaigns(timestamp DESC)"
+    )
+    conn.commit()
+    return conn
+
+@st.cache_resource
+def get_db_connection():
+    """Process-wide connection: pragmas and schema run once, and calls
+    skip the per-call open/close cost"""
+    return init_campaign_db()
+
+def save_campaign_to_db(campaign_results, df=None):
+    """
+    Persist a finished campaign so history survives reruns and session
+    timeouts instead of growing in session state. Per-recipient results
+    land in campaign_details via one executemany in the same
+    transaction as the summary row - not an INSERT per recipient.
+    """
+    conn = get_db_connection()
+    try:
+        cur = conn.execute(
+            "INSERT INTO campaigns (timestamp, sent, failed, skipped, test_mode)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (
+                campaign_results['timestamp'].isoformat(),
+                campaign_results['sent'],
+                campaign_results['failed'],
+                campaign_results.get('skipped', 0),
+                int(campaign_results.get('test_mode', False)),
+            )
+        )
+        if df is not None and len(df):
+            campaign_id = cur.lastrowid
+
+            def _col(name):
+                if name in df.columns:
+                    return df[name].fillna('').astype(str)
+                return [''] * len(df)
+
+            conn.executemany(
+                "INSERT INTO campaign_details"
+                " (campaign_id, customer_name, phone, status, error_message, sent_time)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    (campaign_id, name, phone, status, error, sent_time)
+                    for name, phone, status, error, sent_time in zip(
+                        _col('Customer Name'), _col('Phone'), _col('SMS_Status'),
+                        _col('Error'), _col('Sent_Time')
+                    )
+                )
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    cached_campaign_history.clear()
+
+def get_campaign_history(limit=50, offset=0):
+    """A page of campaign summaries as dicts, newest first
+
+    success_rate is computed in SQL so display code doesn't loop over
+    rows to format it; offset/limit let the history page fetch only the
+    slice it will actually render.
+    """
+    conn = get_db_connection()
+    # Iterate the cursor directly - no fetchall() intermediate list
+    return [dict(row) for row in conn.execute(
+        "SELECT id, timestamp, sent, failed, skipped, test_mode,"
+        " ROUND(sent * 100.0 / NULLIF(sent + failed, 0), 1) AS success_rate"
+        " FROM campaigns ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+        (limit, offset)
+    )]
+
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_campaign_history(limit=20, offset=0):
+    """History for page renders: at most one SELECT per 30s per session
+
+    save_campaign_to_db clears this cache so a fresh campaign shows up
+    immediately.
+    """
+    return get_campaign_history(limit, offset)